@@ -1,14 +1,22 @@
 import os
+import functools
 import hashlib
+import itertools
 import asyncio
 import logging
 import json
+import mmap
 import re
+import secrets
 import sqlite3
+import threading
 import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from pathlib import Path
-from datetime import datetime, timedelta, timezone
-from typing import Optional, List, Tuple, Dict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Optional, List, Tuple, Dict, Set, Iterable
 import logging
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
@@ -17,6 +25,7 @@ import tweepy
 from telegram import Update
 from telegram.ext import (
     ApplicationBuilder,
+    CallbackContext,
     MessageHandler,
     filters,
     ContextTypes,
@@ -51,92 +60,376 @@ HASH_TRACK_FILE = Path("posted_hashes.txt")
 LAST_POST_FILE = Path("lastpost.txt")
 DB_FILE = "queue.sqlite3"
 
+# media kind by lowercase extension; anything else is posted as "other"
+_EXT_KIND = {
+    ".mp4": "video", ".mov": "video", ".mkv": "video", ".webm": "video",
+    ".jpg": "photo", ".jpeg": "photo", ".png": "photo", ".gif": "photo", ".webp": "photo",
+}
+
+def _now_ts() -> int:
+    # POSIX seconds; no datetime objects needed just to get "now"
+    return int(time.time())
+
+def _ext(path: str) -> str:
+    # lowercase only the extension, not the whole path
+    return os.path.splitext(path)[1].lower()
+
 # ======= SQLite Queue ==========
+# One connection for the life of the process. PTB callbacks and worker threads
+# share it, so every use goes through _DB_LOCK.
+# The connection is in autocommit mode; writes go through tx(), which takes the
+# SQLite write lock once up front and commits the whole batch together.
+# Queue SQL is kept as fixed literals so sqlite3's statement cache serves every call.
+_CONN = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None)
+_DB_LOCK = threading.Lock()
+
+@contextmanager
+def tx():
+    with _DB_LOCK:
+        _CONN.execute("BEGIN IMMEDIATE")
+        try:
+            yield _CONN
+            _CONN.execute("COMMIT")
+        except BaseException:
+            # a failed COMMIT can leave the transaction open; never leave it that way
+            if _CONN.in_transaction:
+                _CONN.execute("ROLLBACK")
+            raise
+
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL;",
+    "PRAGMA synchronous=NORMAL;",
+    "PRAGMA cache_size=-64000;",
+    "PRAGMA temp_store=MEMORY;",
+    "PRAGMA busy_timeout=5000;",
+    "PRAGMA mmap_size=134217728;",
+)
+
+# Each queued file is its own queue_files row keyed by (queue_id, idx), next to
+# its Telegram file id and digest. Older databases kept the paths on the queue
+# row as a JSON list; db_init moves those rows over.
+def _migrate_legacy_rows(columns: Set[str]):
+    if "media_paths" not in columns:
+        return
+    rows = _CONN.execute("SELECT id, media_paths FROM queue WHERE media_paths IS NOT NULL").fetchall()
+    if not rows:
+        return
+    files = [
+        (row_id, idx, p, None, None)
+        for row_id, media_json in rows
+        for idx, p in enumerate(json.loads(media_json) if media_json else [])
+    ]
+    _CONN.executemany(
+        "INSERT OR IGNORE INTO queue_files (queue_id, idx, path, unique_id, digest) VALUES (?, ?, ?, ?, ?)", files
+    )
+    _CONN.execute("UPDATE queue SET media_paths = NULL WHERE media_paths IS NOT NULL")
+    log.info(f"Moved media of {len(rows)} queued post(s) into queue_files.")
+
 def db_init():
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.execute("PRAGMA journal_mode=WAL;")
-        conn.execute(
+    with _DB_LOCK:
+        for pragma in DB_PRAGMAS:
+            _CONN.execute(pragma)
+    with tx():
+        _CONN.execute(
             "CREATE TABLE IF NOT EXISTS queue ("
             "id INTEGER PRIMARY KEY AUTOINCREMENT, "
-            "media_paths TEXT, caption TEXT, scheduled_time INTEGER)"
+            "caption TEXT, scheduled_time INTEGER)"
+        )
+        _CONN.execute("CREATE INDEX IF NOT EXISTS idx_queue_sched ON queue(scheduled_time)")
+        _CONN.execute(
+            "CREATE TABLE IF NOT EXISTS queue_files ("
+            "queue_id INTEGER NOT NULL, idx INTEGER NOT NULL, path TEXT NOT NULL, "
+            "unique_id TEXT, digest TEXT, PRIMARY KEY (queue_id, idx)) WITHOUT ROWID"
+        )
+        _migrate_legacy_rows({row[1] for row in _CONN.execute("PRAGMA table_info(queue)")})
+        _CONN.execute("CREATE TABLE IF NOT EXISTS posted_hashes (hash TEXT PRIMARY KEY) WITHOUT ROWID")
+        _CONN.execute("CREATE TABLE IF NOT EXISTS posted_unique_ids (unique_id TEXT PRIMARY KEY) WITHOUT ROWID")
+        _CONN.execute(
+            "CREATE TABLE IF NOT EXISTS pending_approvals ("
+            "id TEXT PRIMARY KEY, media_paths TEXT, caption TEXT, "
+            "hashes TEXT, unique_ids TEXT, created_at INTEGER)"
         )
-        conn.commit()
 
-def db_add_queue_item(paths: List[str], caption: str, scheduled_time: int):
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.execute(
-            "INSERT INTO queue (media_paths, caption, scheduled_time) VALUES (?, ?, ?)",
-            (json.dumps(paths), caption, scheduled_time)
+# (paths, caption, scheduled_time, path -> file_unique_id, path -> sha256)
+QueueItem = Tuple[List[str], str, int, Optional[Dict[str, str]], Optional[Dict[str, str]]]
+
+def db_add_queue_items(items: List[QueueItem]):
+    with tx():
+        files = []
+        for paths, caption, scheduled_time, unique_ids, digests in items:
+            queue_id = _CONN.execute(
+                "INSERT INTO queue (caption, scheduled_time) VALUES (?, ?)", (caption, scheduled_time)
+            ).lastrowid
+            unique_ids, digests = unique_ids or {}, digests or {}
+            files.extend((queue_id, idx, p, unique_ids.get(p), digests.get(p)) for idx, p in enumerate(paths))
+        _CONN.executemany(
+            "INSERT INTO queue_files (queue_id, idx, path, unique_id, digest) VALUES (?, ?, ?, ?, ?)", files
         )
-        conn.commit()
 
 def db_get_next_items(n=5):
-    with sqlite3.connect(DB_FILE) as conn:
-        cur = conn.execute(
-            "SELECT id, media_paths, caption, scheduled_time FROM queue "
-            "ORDER BY scheduled_time ASC LIMIT ?", (n,)
+    with _DB_LOCK:
+        cur = _CONN.execute(
+            "SELECT q.id, q.caption, q.scheduled_time, f.path FROM "
+            "(SELECT id, caption, scheduled_time FROM queue ORDER BY scheduled_time ASC LIMIT ?) q "
+            "LEFT JOIN queue_files f ON f.queue_id = q.id "
+            "ORDER BY q.scheduled_time, q.id, f.idx", (n,)
         )
-        return cur.fetchall()
-
-def db_pop_due_items():
-    now = int(datetime.now(timezone.utc).timestamp())
-    with sqlite3.connect(DB_FILE) as conn:
-        cur = conn.execute(
-            "SELECT id, media_paths, caption, scheduled_time FROM queue "
-            "WHERE scheduled_time <= ?", (now,)
+        items: Dict[int, Tuple[int, List[str], str, int]] = {}
+        for row_id, caption, scheduled_time, path in cur:
+            item = items.setdefault(row_id, (row_id, [], caption, scheduled_time))
+            if path is not None:
+                item[1].append(path)
+    return list(items.values())
+
+def db_pop_due_items() -> List[QueueItem]:
+    now = _now_ts()
+    with tx():
+        files = _CONN.execute(
+            "SELECT f.queue_id, f.path, f.unique_id, f.digest FROM queue_files f "
+            "JOIN queue q ON q.id = f.queue_id WHERE q.scheduled_time <= ? "
+            "ORDER BY f.queue_id, f.idx", (now,)
+        ).fetchall()
+        _CONN.execute(
+            "DELETE FROM queue_files WHERE queue_id IN (SELECT id FROM queue WHERE scheduled_time <= ?)", (now,)
         )
-        rows = cur.fetchall()
-        ids = [row[0] for row in rows]
-        if ids:
-            conn.executemany("DELETE FROM queue WHERE id=?", [(id,) for id in ids])
-        conn.commit()
-    return rows
+        if sqlite3.sqlite_version_info >= (3, 35, 0):
+            # remove and return due rows in one statement
+            rows = _CONN.execute(
+                "DELETE FROM queue WHERE scheduled_time <= ? RETURNING id, caption, scheduled_time", (now,)
+            ).fetchall()
+        else:
+            rows = _CONN.execute(
+                "SELECT id, caption, scheduled_time FROM queue WHERE scheduled_time <= ?", (now,)
+            ).fetchall()
+            _CONN.execute("DELETE FROM queue WHERE scheduled_time <= ?", (now,))
+    items = {row_id: ([], caption, scheduled_time, {}, {}) for row_id, caption, scheduled_time in rows}
+    for queue_id, path, unique_id, digest in files:
+        paths, _, _, unique_ids, digests = items[queue_id]
+        paths.append(path)
+        if unique_id:
+            unique_ids[path] = unique_id
+        if digest:
+            digests[path] = digest
+    return sorted(items.values(), key=lambda item: item[2])
+
+def db_next_due_time() -> Optional[int]:
+    with _DB_LOCK:
+        row = _CONN.execute("SELECT MIN(scheduled_time) FROM queue").fetchone()
+    return row[0]
 
 def db_clear_queue():
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.execute("DELETE FROM queue")
-        conn.commit()
+    with tx():
+        _CONN.execute("DELETE FROM queue_files")
+        _CONN.execute("DELETE FROM queue")
+
+def db_add_posted_hashes(digests: Iterable[str]):
+    # digests may be a generator (the legacy log import); executemany streams it
+    with tx():
+        _CONN.executemany("INSERT OR IGNORE INTO posted_hashes (hash) VALUES (?)", ((h,) for h in digests))
+
+def db_add_posted_unique_ids(unique_ids: List[str]):
+    with tx():
+        _CONN.executemany(
+            "INSERT OR IGNORE INTO posted_unique_ids (unique_id) VALUES (?)", [(u,) for u in unique_ids]
+        )
 
-# ======= Scheduling Parser ==========
-def parse_schedule_from_caption(caption: str) -> Optional[int]:
-    m = re.search(r"#at\s+([0-9\-: Tt]+)", caption)
-    if m:
-        timestr = m.group(1).replace('t', 'T').replace('T', ' ')
+def db_iter_posted_hashes():
+    with _DB_LOCK:
+        yield from (row[0] for row in _CONN.execute("SELECT hash FROM posted_hashes"))
+
+def db_iter_posted_unique_ids():
+    with _DB_LOCK:
+        yield from (row[0] for row in _CONN.execute("SELECT unique_id FROM posted_unique_ids"))
+
+# Duplicate approvals survive restarts; paths and the per-path dicts are stored as JSON.
+def db_save_approval(approval_id: str, item: Dict, drop_ids: Iterable[str] = ()):
+    with tx():
+        _CONN.executemany("DELETE FROM pending_approvals WHERE id = ?", [(aid,) for aid in drop_ids])
+        _CONN.execute(
+            "INSERT OR REPLACE INTO pending_approvals "
+            "(id, media_paths, caption, hashes, unique_ids, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (approval_id, json.dumps(item["media_paths"]), item["caption"],
+             json.dumps(item["hashes"] or {}), json.dumps(item["unique_ids"] or {}), item["created_at"])
+        )
+
+def db_delete_approvals(approval_ids: Iterable[str]):
+    with tx():
+        _CONN.executemany("DELETE FROM pending_approvals WHERE id = ?", [(aid,) for aid in approval_ids])
+
+def db_load_approvals() -> List[Tuple[str, Dict]]:
+    with _DB_LOCK:
+        rows = _CONN.execute(
+            "SELECT id, media_paths, caption, hashes, unique_ids, created_at "
+            "FROM pending_approvals ORDER BY created_at"
+        ).fetchall()
+    return [
+        (aid, {"media_paths": json.loads(paths), "caption": caption, "hashes": json.loads(hashes),
+               "unique_ids": json.loads(unique_ids), "created_at": created_at})
+        for aid, paths, caption, hashes, unique_ids, created_at in rows
+    ]
+
+# ======= Batched Queue Inserts ==========
+# Incoming posts are buffered briefly so a burst of albums lands in one
+# transaction; callers wait until their row is committed.
+INSERT_FLUSH_DELAY = 0.05
+INSERT_BATCH_MAX = 64
+_insert_buffer: asyncio.Queue = asyncio.Queue()
+_insert_writer: Optional[asyncio.Task] = None
+# set after every committed insert so the poster re-reads the next due time
+_queue_changed = asyncio.Event()
+
+async def db_add_queue_item_async(paths: List[str], caption: str, scheduled_time: int,
+                                  unique_ids: Optional[Dict[str, str]] = None,
+                                  digests: Optional[Dict[str, str]] = None):
+    global _insert_writer
+    committed = asyncio.get_running_loop().create_future()
+    _insert_buffer.put_nowait(((paths, caption, scheduled_time, unique_ids, digests), committed))
+    if _insert_writer is None or _insert_writer.done():
+        _insert_writer = asyncio.create_task(_flush_inserts())
+    await committed
+
+async def _flush_inserts():
+    while not _insert_buffer.empty():
+        if _insert_buffer.qsize() < INSERT_BATCH_MAX:
+            await asyncio.sleep(INSERT_FLUSH_DELAY)
+        batch = []
+        while not _insert_buffer.empty() and len(batch) < INSERT_BATCH_MAX:
+            batch.append(_insert_buffer.get_nowait())
+        items = [item for item, _ in batch]
         try:
-            dt = datetime.strptime(timestr.strip(), "%Y-%m-%d %H:%M")
-        except ValueError:
-            try:
-                dt = datetime.strptime(timestr.strip(), "%Y-%m-%dT%H:%M")
-            except Exception:
-                return None
-        dt = dt.replace(tzinfo=timezone.utc)
-        return int(dt.timestamp())
-    m = re.search(r"#in\s+([0-9]+)\s*m(?:in)?", caption)
-    if m:
-        mins = int(m.group(1))
-        return int((datetime.now(timezone.utc) + timedelta(minutes=mins)).timestamp())
-    m = re.search(r"#in\s+([0-9]+)\s*h(?:our)?", caption)
-    if m:
-        hrs = int(m.group(1))
-        return int((datetime.now(timezone.utc) + timedelta(hours=hrs)).timestamp())
-    return None
-
-def strip_schedule_from_caption(caption: str) -> str:
-    caption = re.sub(r"#in\s+\d+\s*[mh](in|our)?", "", caption, flags=re.IGNORECASE)
-    caption = re.sub(r"#at\s+[0-9\-: Tt]+", "", caption, flags=re.IGNORECASE)
-    return re.sub(r"\s+", " ", caption).strip()
+            await asyncio.to_thread(db_add_queue_items, items)
+        except Exception as e:
+            for _, committed in batch:
+                if not committed.done():
+                    committed.set_exception(e)
+            continue
+        for _, committed in batch:
+            if not committed.done():
+                committed.set_result(None)
+        _queue_changed.set()
+
+# ======= Scheduling Parser ==========
+# One pass over the caption finds every #at/#in tag and strips it. Captions come
+# from anyone posting to the channel, so the repeats are bounded: an unbounded
+# run after "#at" overlaps \s+ and backtracks quadratically, and an unbounded
+# #in amount can overflow datetime when the post time is formatted.
+_RE_SCHEDULE = re.compile(r"#at\s{1,8}([0-9\-: Tt]{1,32})|#in\s{1,8}(\d{1,6})\s{0,8}(m(?:in)?|h(?:our)?)", re.IGNORECASE)
+_RE_WS = re.compile(r"\s+")
+
+def _parse_at(timestr: str) -> Optional[int]:
+    # "2024-05-01T12:30" and "2024-05-01 12:30" both normalise to the space form
+    timestr = timestr.replace('t', ' ').replace('T', ' ').strip()
+    try:
+        dt = datetime.strptime(timestr, "%Y-%m-%d %H:%M")
+    except ValueError:
+        return None
+    return int(dt.replace(tzinfo=timezone.utc).timestamp())
+
+def parse_and_strip(caption: str) -> Tuple[Optional[int], str]:
+    # returns (scheduled UTC timestamp or None, caption without schedule tags);
+    # an #at tag wins over #in, otherwise the first tag of each kind is used
+    found: Dict[str, re.Match] = {}
+
+    def _take(m: re.Match) -> str:
+        found.setdefault("at" if m.group(1) is not None else "in", m)
+        return ""
+
+    clean = _RE_WS.sub(" ", _RE_SCHEDULE.sub(_take, caption)).strip()
+    if "at" in found:
+        return _parse_at(found["at"].group(1)), clean
+    if "in" in found:
+        m = found["in"]
+        amount = int(m.group(2))
+        return _now_ts() + amount * (60 if m.group(3)[0] in "mM" else 3600), clean
+    return None, clean
 
 # ======= Twitter/Tweepy Setup ==========
+MMAP_HASH_THRESHOLD = 1 << 20
+MMAP_HASH_CHUNK = 16 << 20
+
+def _new_sha256():
+    # dedup fingerprint, not a security primitive
+    return hashlib.new("sha256", usedforsecurity=False)
+
 def hash_file(filepath: str) -> str:
-    h = hashlib.sha256()
-    with open(filepath, "rb") as f:
-        while True:
-            chunk = f.read(8192)
-            if not chunk:
-                break
-            h.update(chunk)
+    # unbuffered so file_digest reads straight into its own buffer
+    with open(filepath, "rb", buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            # mmap rejects empty files
+            return _new_sha256().hexdigest()
+        if size < MMAP_HASH_THRESHOLD and hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(f, _new_sha256).hexdigest()
+        # large videos (and Python < 3.11): let the kernel page the file straight
+        # into the hasher instead of copying it through a read buffer
+        h = _new_sha256()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+            for off in range(0, size, MMAP_HASH_CHUNK):
+                h.update(view[off:off + MMAP_HASH_CHUNK])
+        return h.hexdigest()
+
+def save_and_hash(path: Path, data: bytearray) -> str:
+    # hash the downloaded bytes while they are in memory so posting never re-reads the file
+    h = _new_sha256()
+    h.update(memoryview(data))
+    path.write_bytes(data)
     return h.hexdigest()
 
+@functools.lru_cache(maxsize=1024)
+def _hash_file_cached(filepath: str, size: int, mtime_ns: int) -> str:
+    return hash_file(filepath)
+
+def cached_hash(filepath: str) -> str:
+    # size/mtime are part of the key, so a rewritten file is hashed again
+    st = os.stat(filepath)
+    return _hash_file_cached(filepath, st.st_size, st.st_mtime_ns)
+
+# ======= Posted hash tracking ==========
+# The set only keeps a 64-bit prefix of each digest; the table keeps the full one.
+HASH_KEY_LEN = 16
+posted_hashes: Set[str] = set()
+
+# Telegram file_unique_ids of posted media: a repeat is a duplicate without hashing
+posted_unique_ids: Set[str] = set()
+
+def _hash_key(digest: str) -> str:
+    return digest[:HASH_KEY_LEN]
+
+def is_posted_hash(digest: str) -> bool:
+    return _hash_key(digest) in posted_hashes
+
+def _read_log(path: Path):
+    # stream the log; it grows forever, so avoid holding it as one string + list
+    with path.open("r", encoding="utf-8") as f:
+        yield from (line for line in map(str.strip, f) if line)
+
+def _migrate_posted_log():
+    # the flat-file hash log predates the SQLite table; import it once and keep it aside
+    if HASH_TRACK_FILE.exists():
+        db_add_posted_hashes(_read_log(HASH_TRACK_FILE))
+        HASH_TRACK_FILE.rename(HASH_TRACK_FILE.with_name(HASH_TRACK_FILE.name + ".migrated"))
+        log.info(f"Migrated {HASH_TRACK_FILE} into {DB_FILE}.")
+
+def load_posted_hashes():
+    _migrate_posted_log()
+    posted_hashes.update(_hash_key(h) for h in db_iter_posted_hashes())
+    posted_unique_ids.update(db_iter_posted_unique_ids())
+    log.info(f"Loaded {len(posted_hashes)} posted hashes and {len(posted_unique_ids)} posted file ids.")
+
+def record_hashes(digests: Iterable[str]):
+    new = [h for h in dict.fromkeys(digests) if not is_posted_hash(h)]
+    if not new:
+        return
+    db_add_posted_hashes(new)
+    posted_hashes.update(_hash_key(h) for h in new)
+
+def record_unique_ids(unique_ids: Iterable[str]):
+    new = [u for u in dict.fromkeys(unique_ids) if u not in posted_unique_ids]
+    if not new:
+        return
+    db_add_posted_unique_ids(new)
+    posted_unique_ids.update(new)
+
 client = tweepy.Client(
     bearer_token=BEARER_TOKEN,
     consumer_key=CONSUMER_KEY,
@@ -147,43 +440,190 @@ client = tweepy.Client(
 v1_auth = tweepy.OAuth1UserHandler(CONSUMER_KEY, CONSUMER_SECRET, ACCESS_TOKEN, ACCESS_SECRET)
 api_v1 = tweepy.API(v1_auth)
 
+# Uploads are network-bound and tweepy releases the GIL while waiting on the
+# socket, so a small dedicated thread pool is enough; it also caps how many
+# uploads hit Twitter at once.
+UPLOAD_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="media-upload")
+
+async def _upload_media(path: str):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(UPLOAD_POOL, api_v1.media_upload, path)
+
+# v2 tweet writes are capped at 300 per 3 hours; spend that budget as a token bucket
+TWEET_RATE_LIMIT = 300
+TWEET_RATE_PERIOD = 3 * 60 * 60
+RATE_LIMIT_BACKOFF = 900
+RATE_LIMIT_BACKOFF_MAX = 3 * 60 * 60
+
+class _TokenBucket:
+    def __init__(self, rate: int, period: float):
+        self.capacity = rate
+        self.fill_rate = rate / period
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self.lock:
+            self._refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.fill_rate)
+                self._refill()
+            self.tokens -= 1
+
+_TWEET_LIMITER = _TokenBucket(TWEET_RATE_LIMIT, TWEET_RATE_PERIOD)
+
+# After a 429 nothing is sent to Twitter until _rate_limited_until (POSIX seconds),
+# taken from the response's x-rate-limit-reset header when present. Without it the
+# wait doubles per consecutive window, starting at RATE_LIMIT_BACKOFF.
+_rate_limited_until = 0
+_rate_limit_strikes = 0
+
+def _rate_limit_window(e: tweepy.errors.TooManyRequests) -> int:
+    global _rate_limited_until, _rate_limit_strikes
+    now = _now_ts()
+    if now < _rate_limited_until:
+        # another call in flight hit the same window; it has already been counted
+        return _rate_limited_until
+    _rate_limit_strikes += 1
+    try:
+        reset = int(e.response.headers["x-rate-limit-reset"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        reset = 0
+    if reset > now:
+        _rate_limited_until = reset
+    else:
+        _rate_limited_until = now + min(RATE_LIMIT_BACKOFF << (_rate_limit_strikes - 1), RATE_LIMIT_BACKOFF_MAX)
+    return _rate_limited_until
+
+async def _requeue_if_rate_limited(file_paths: list, caption: str,
+                                   unique_ids: Optional[Dict[str, str]], hashes: Optional[Dict[str, str]]) -> bool:
+    if _now_ts() >= _rate_limited_until:
+        return False
+    await db_add_queue_item_async(file_paths, caption, _rate_limited_until, unique_ids, hashes)
+    log.info(f"Rate limited until {datetime.fromtimestamp(_rate_limited_until, timezone.utc):%H:%M UTC}; requeued post.")
+    return True
+
+async def _create_tweet(**kwargs):
+    await _TWEET_LIMITER.acquire()
+    # tweepy is synchronous; keep the HTTP round-trip off the event loop
+    return await asyncio.to_thread(client.create_tweet, **kwargs)
+
 # ======= Album Buffering (with debounce) ===========
-pending_albums: Dict[Tuple[int, str], List[Dict]] = {}
+# Albums normally finalize within seconds, but both maps are capped (oldest
+# album dropped first) and swept by pending_janitor so a stuck album can't leak.
+PENDING_ALBUMS_MAX = 1024
+pending_albums: OrderedDict[Tuple[int, str], List[Dict]] = OrderedDict()
 pending_album_tasks: Dict[Tuple[int, str], asyncio.Task] = {}
+# one debounce task per album; each new item only pushes its deadline back
+ALBUM_DEBOUNCE = 1.8
+pending_album_deadlines: Dict[Tuple[int, str], float] = {}
+
+def _drop_album(key: Tuple[int, str]):
+    pending_album_deadlines.pop(key, None)
+    task = pending_album_tasks.pop(key, None)
+    if task:
+        task.cancel()
+    for item in pending_albums.pop(key, None) or []:
+        item['download'].cancel()
 
 # ======= Duplicate approval storage ===========
-pending_approvals: Dict[str, Dict] = {}
+# Unanswered approvals expire after PENDING_APPROVAL_TTL; the oldest is dropped
+# once PENDING_APPROVALS_MAX are waiting. The dict mirrors the pending_approvals table.
+PENDING_APPROVALS_MAX = 256
+PENDING_APPROVAL_TTL = 24 * 60 * 60
+pending_approvals: OrderedDict[str, Dict] = OrderedDict()
+
+def _expire_approvals() -> Dict[str, Dict]:
+    # insertion order is creation order, so expired entries are all at the head
+    cutoff = time.time() - PENDING_APPROVAL_TTL
+    expired = {}
+    while pending_approvals:
+        aid, item = next(iter(pending_approvals.items()))
+        if item["created_at"] >= cutoff:
+            break
+        del pending_approvals[aid]
+        expired[aid] = item
+    return expired
+
+async def _notify_dropped_approvals(dropped: Dict[str, Dict], context, reason: str):
+    # a dropped approval is never posted, so tell the admin what went away
+    if not dropped:
+        return
+    lines = [f"🗑️ Dropped {len(dropped)} pending approval(s) ({reason}); these posts will not be tweeted:"]
+    for aid, item in dropped.items():
+        paths = item["media_paths"]
+        files = ", ".join(paths[:4]) + (f" (+{len(paths)-4} more)" if len(paths) > 4 else "")
+        lines.append(f"{aid}: {files or '(text only)'}")
+    text = "\n".join(lines)
+    if len(text) > 4000:
+        text = text[:4000] + "\n..."
+    try:
+        await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=text)
+    except Exception as e:
+        log.warning(f"Failed to notify admin about dropped approvals: {e}")
+
+# short and unique within this process, unlike millisecond timestamps; the random
+# suffix keeps an /ok for an id from before a restart from hitting a new approval
+_approval_counter = itertools.count(1)
 
 def _new_approval_id() -> str:
-    return str(int(time.time() * 1000))
+    while True:
+        approval_id = f"{next(_approval_counter):x}{secrets.token_hex(2)}"
+        # approvals loaded from before a restart share the counter's range
+        if approval_id not in pending_approvals:
+            return approval_id
+
+def load_pending_approvals():
+    # approvals that expired while the bot was down are dropped by
+    # _drop_expired_approvals once the bot can message the admin
+    pending_approvals.update(db_load_approvals())
+    if pending_approvals:
+        log.info(f"Loaded {len(pending_approvals)} pending approval(s).")
 
 async def finalize_album(chat_id, group_id, context):
     key = (chat_id, group_id)
     pending_album_tasks.pop(key, None)
+    pending_album_deadlines.pop(key, None)
     items = pending_albums.pop(key, None)
     if not items:
         return
 
-    caption = items[0]['caption']
-    post_time = parse_schedule_from_caption(caption) or int(datetime.now(timezone.utc).timestamp())
-    clean_caption = strip_schedule_from_caption(caption)
+    clean_caption = items[0]['clean_caption']
+    post_time = items[0]['post_time'] or _now_ts()
+
+    results = await asyncio.gather(*(i['download'] for i in items), return_exceptions=True)
+    for item, result in zip(items, results):
+        if isinstance(result, Exception):
+            log.error(f"Album media download failed: {result}")
+        else:
+            item['file'], item['digest'] = result
+    items = [i for i in items if 'file' in i]
+    if not items:
+        return
 
-    videos = [i for i in items if i['type'] == 'video']
-    photos = [i for i in items if i['type'] == 'photo']
-    others = [i for i in items if i['type'] not in ('video', 'photo')]
+    videos, photos, others = [], [], []
+    buckets = {'video': videos, 'photo': photos}
+    for i in items:
+        buckets.get(i['type'], others).append(i)
 
     if len(videos) == 1 and photos:
-        media_paths = [videos[0]['file']] + [p['file'] for p in photos]
-        db_add_queue_item(media_paths, clean_caption, post_time)
+        chosen = videos[:1] + photos
     elif len(videos) > 1:
-        media_paths = [v['file'] for v in videos] + [p['file'] for p in photos] + [o['file'] for o in others]
-        db_add_queue_item(media_paths, clean_caption, post_time)
+        chosen = videos + photos + others
     elif photos:
-        media_paths = [p['file'] for p in photos[:4]]
-        db_add_queue_item(media_paths, clean_caption, post_time)
+        chosen = photos[:4]
     else:
-        media_paths = [items[0]['file']]
-        db_add_queue_item(media_paths, clean_caption, post_time)
+        chosen = items[:1]
+    media_paths = [i['file'] for i in chosen]
+    unique_ids = {i['file']: i['unique_id'] for i in chosen}
+    digests = {i['file']: i['digest'] for i in chosen}
+    await db_add_queue_item_async(media_paths, clean_caption, post_time, unique_ids, digests)
 
     # keep informative queued notification
     await context.bot.send_message(
@@ -191,28 +631,35 @@ async def finalize_album(chat_id, group_id, context):
         text=f"Album queued for {datetime.fromtimestamp(post_time, timezone.utc):%Y-%m-%d %H:%M UTC}"
     )
 
+_MIME_KIND = {"image": "photo", "video": "video"}
+
 def infer_type_from_document(msg) -> str:
     doc = getattr(msg, "document", None)
     if not doc:
         return "document"
-    mime = getattr(doc, "mime_type", "") or ""
-    fname = getattr(doc, "file_name", "") or ""
-    mime = mime.lower()
-    fname = fname.lower()
-    if "image" in mime or fname.endswith((".jpg", ".jpeg", ".png", ".gif", ".webp")):
-        return "photo"
-    if "video" in mime or fname.endswith((".mp4", ".mov", ".mkv", ".webm")):
-        return "video"
-    return "document"
-
-async def _delayed_finalize(key: Tuple[int, str], context: ContextTypes.DEFAULT_TYPE, delay: float = 1.8):
+    # the MIME major type decides; the file extension is the fallback
+    mime = (getattr(doc, "mime_type", "") or "").partition("/")[0].lower()
+    kind = _MIME_KIND.get(mime)
+    if kind:
+        return kind
+    return _EXT_KIND.get(_ext(getattr(doc, "file_name", "") or ""), "document")
+
+async def _delayed_finalize(key: Tuple[int, str], context: ContextTypes.DEFAULT_TYPE):
+    loop = asyncio.get_running_loop()
     try:
-        await asyncio.sleep(delay)
+        remaining = pending_album_deadlines.get(key, 0) - loop.time()
+        while remaining > 0:
+            await asyncio.sleep(remaining)
+            remaining = pending_album_deadlines.get(key, 0) - loop.time()
         await finalize_album(key[0], key[1], context)
     except asyncio.CancelledError:
         pass
+    except Exception:
+        log.exception(f"Failed to queue album {key}")
     finally:
-        pending_album_tasks.pop(key, None)
+        # a cancelled run must not unregister the task that replaced it
+        if pending_album_tasks.get(key) is asyncio.current_task():
+            del pending_album_tasks[key]
 
 async def media_to_queue(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.effective_message
@@ -227,137 +674,209 @@ async def media_to_queue(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     async def dl_file(file_obj):
         tg_file = await file_obj.get_file()
-        saved = await tg_file.download_to_drive()
-        return str(saved)
+        data = await tg_file.download_as_bytearray()
+        # same target name download_to_drive() would pick
+        saved = Path(Path(tg_file.file_path).name) if tg_file.file_path else Path.cwd() / tg_file.file_id
+        digest = await asyncio.to_thread(save_and_hash, saved, data)
+        return str(saved), digest
 
     media_type = None
-    file_path = None
+    media_obj = None
 
     if getattr(msg, "video", None):
         media_type = 'video'
-        file_path = await dl_file(msg.video)
+        media_obj = msg.video
     elif getattr(msg, "photo", None):
         media_type = 'photo'
-        file_path = await dl_file(msg.photo[-1])
+        media_obj = msg.photo[-1]
     elif getattr(msg, "document", None):
         media_type = infer_type_from_document(msg)
-        file_path = await dl_file(msg.document)
+        media_obj = msg.document
 
-    if getattr(msg, "media_group_id", None):
+    if getattr(msg, "media_group_id", None) and media_obj:
         key = (chat_obj.id, msg.media_group_id)
-        pending_albums.setdefault(key, []).append({'file': file_path, 'caption': caption, 'type': media_type})
-
-        existing = pending_album_tasks.get(key)
-        if existing and not existing.done():
-            existing.cancel()
-        task = asyncio.create_task(_delayed_finalize(key, context, delay=1.8))
-        pending_album_tasks[key] = task
+        # start the download without waiting for it; finalize_album gathers the whole album
+        download = asyncio.create_task(dl_file(media_obj))
+        items = pending_albums.get(key)
+        if items is None:
+            items = pending_albums[key] = []
+            if len(pending_albums) > PENDING_ALBUMS_MAX:
+                oldest = next(iter(pending_albums))
+                log.warning(f"Too many pending albums; dropping {oldest}")
+                _drop_album(oldest)
+        else:
+            pending_albums.move_to_end(key)
+        entry = {'download': download, 'type': media_type, 'unique_id': media_obj.file_unique_id}
+        if not items:
+            # the album's schedule comes from its first item; parse it once, on arrival
+            entry['post_time'], entry['clean_caption'] = parse_and_strip(caption)
+        items.append(entry)
+
+        pending_album_deadlines[key] = asyncio.get_running_loop().time() + ALBUM_DEBOUNCE
+        task = pending_album_tasks.get(key)
+        if task is None or task.done():
+            pending_album_tasks[key] = asyncio.create_task(_delayed_finalize(key, context))
 
     else:
-        post_time = parse_schedule_from_caption(caption) or int(datetime.now(timezone.utc).timestamp())
-        clean_caption = strip_schedule_from_caption(caption)
-        if file_path:
-            db_add_queue_item([file_path], clean_caption, post_time)
+        post_time, clean_caption = parse_and_strip(caption)
+        post_time = post_time or _now_ts()
+        if media_obj:
+            file_path, digest = await dl_file(media_obj)
+            await db_add_queue_item_async([file_path], clean_caption, post_time,
+                                          {file_path: media_obj.file_unique_id}, {file_path: digest})
         else:
-            db_add_queue_item([], clean_caption, post_time)
+            await db_add_queue_item_async([], clean_caption, post_time)
 
         await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=
             f"Queued post for {datetime.fromtimestamp(post_time, timezone.utc):%Y-%m-%d %H:%M UTC}")
 
 # ============= Posting Logic & Approval Handling ==============
-async def _post_media_now(file_paths: list, caption: str, context: ContextTypes.DEFAULT_TYPE):
+async def _post_media_now(file_paths: list, caption: str, context: ContextTypes.DEFAULT_TYPE,
+                          hashes: Optional[Dict[str, str]] = None, unique_ids: Optional[Dict[str, str]] = None):
+    global _rate_limit_strikes
+    if await _requeue_if_rate_limited(file_paths, caption, unique_ids, hashes):
+        return
     if not file_paths:
-        client.create_tweet(text=caption)
+        await _create_tweet(text=caption)
         if context:
             await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=f"✅ Twitter post successful!\nCaption: {caption[:100]}")
         return
 
-    videos = [p for p in file_paths if p.lower().endswith((".mp4", ".mov", ".mkv", ".webm"))]
-    photos = [p for p in file_paths if p.lower().endswith((".jpg", ".jpeg", ".png", ".gif", ".webp"))]
-    others = [p for p in file_paths if p not in videos and p not in photos]
+    videos, photos, others = [], [], []
+    buckets = {"video": videos, "photo": photos}
+    for p in file_paths:
+        buckets.get(_EXT_KIND.get(_ext(p)), others).append(p)
 
     try:
-        if len(videos) == 1 and photos:
-            vid_media = api_v1.media_upload(videos[0])
-            main_tweet = client.create_tweet(text=caption, media_ids=[vid_media.media_id])
-            main_id = main_tweet.data["id"]
-            await asyncio.sleep(1)
-            for p in photos:
-                m = api_v1.media_upload(p)
-                client.create_tweet(text=caption, media_ids=[m.media_id], in_reply_to_tweet_id=main_id)
-                await asyncio.sleep(1)
-            for o in others:
-                m = api_v1.media_upload(o)
-                client.create_tweet(text="", media_ids=[m.media_id], in_reply_to_tweet_id=main_id)
-                await asyncio.sleep(1)
-
-        elif len(videos) > 1:
-            main_media = api_v1.media_upload(videos[0])
-            main_tweet = client.create_tweet(text=caption, media_ids=[main_media.media_id])
+        posted = file_paths
+        if (len(videos) == 1 and photos) or len(videos) > 1:
+            # upload everything up front; only the tweets themselves need ordering
+            vid_media, photo_media, other_media = await asyncio.gather(
+                asyncio.gather(*map(_upload_media, videos)),
+                asyncio.gather(*map(_upload_media, photos)),
+                asyncio.gather(*map(_upload_media, others)),
+            )
+            main_tweet = await _create_tweet(text=caption, media_ids=[vid_media[0].media_id])
             main_id = main_tweet.data["id"]
-            await asyncio.sleep(1)
-            for v in videos[1:]:
-                vm = api_v1.media_upload(v)
-                client.create_tweet(text="", media_ids=[vm.media_id], in_reply_to_tweet_id=main_id)
-                await asyncio.sleep(1)
-            for p in photos + others:
-                pm = api_v1.media_upload(p)
-                client.create_tweet(text="", media_ids=[pm.media_id], in_reply_to_tweet_id=main_id)
-                await asyncio.sleep(1)
+            if len(videos) == 1:
+                replies = [(caption, m) for m in photo_media] + [("", m) for m in other_media]
+            else:
+                replies = [("", m) for m in vid_media[1:] + photo_media + other_media]
+            for text, m in replies:
+                await _create_tweet(text=text, media_ids=[m.media_id], in_reply_to_tweet_id=main_id)
 
         else:
+            upload_paths = file_paths[:4]
+            uploads = await asyncio.gather(
+                *(_upload_media(mpath) for mpath in upload_paths), return_exceptions=True
+            )
             media_ids = []
-            for mpath in file_paths[:4]:
-                m = api_v1.media_upload(mpath)
-                media_ids.append(m.media_id)
-                await asyncio.sleep(1)
-            client.create_tweet(text=caption, media_ids=media_ids if media_ids else None)
-
-        with open(HASH_TRACK_FILE, "a", encoding="utf-8") as f:
-            for p in file_paths:
-                try:
-                    h = hash_file(p)
-                    f.write(h + "\n")
-                except Exception:
-                    pass
-
+            failed = []
+            posted = []
+            for mpath, m in zip(upload_paths, uploads):
+                if isinstance(m, Exception):
+                    log.warning(f"Media upload failed for {mpath}: {m}")
+                    failed.append(m)
+                else:
+                    media_ids.append(m.media_id)
+                    posted.append(mpath)
+            # nothing uploaded (or rate limited): let the requeue handlers below deal with it
+            rate_limited = [e for e in failed if isinstance(e, tweepy.errors.TooManyRequests)]
+            if rate_limited:
+                raise rate_limited[0]
+            if failed and not media_ids:
+                raise failed[0]
+            await _create_tweet(text=caption, media_ids=media_ids if media_ids else None)
+
+    except tweepy.errors.TooManyRequests as e:
+        retry_at = _rate_limit_window(e)
+        await db_add_queue_item_async(file_paths, caption, retry_at, unique_ids, hashes)
+        when = f"{datetime.fromtimestamp(retry_at, timezone.utc):%Y-%m-%d %H:%M UTC}"
+        log.warning(f"⚠️ Twitter rate limit (429). Requeued post for {when}.")
         if context:
-            try:
-                await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=f"✅ Twitter post successful!\nCaption: {caption[:100]}")
-            except Exception as notify_e:
-                log.warning(f"Could not send success DM: {notify_e}")
-
-    except tweepy.errors.TooManyRequests:
-        db_add_queue_item(file_paths, caption, int(datetime.now(timezone.utc).timestamp()) + 900)
-        log.warning("⚠️ Twitter rate limit (429). Requeued post for +15 minutes.")
-        if context:
-            await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text="❌ Twitter post failed with rate limit (429). Requeued +15 min.")
+            await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=f"❌ Twitter post failed with rate limit (429). Requeued for {when}.")
     except Exception as e:
-        db_add_queue_item(file_paths, caption, int(datetime.now(timezone.utc).timestamp()) + 60)
+        retry_at = _now_ts() + 60
+        await db_add_queue_item_async(file_paths, caption, retry_at, unique_ids, hashes)
         log.error(f"Failed posting tweet: {e}")
         if context:
             await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=f"❌ Twitter post failed, requeued. Reason: {str(e)}")
+    else:
+        # the tweet is out; from here on nothing may requeue it
+        _rate_limit_strikes = 0
+        left_out = [p for p in file_paths if p not in posted]
+        recorded = True
+        try:
+            # only what actually went out counts as posted
+            digests = {p: hashes[p] for p in posted if hashes and p in hashes}
+            missing = [p for p in posted if p not in digests]
+            if missing:
+                found = await asyncio.gather(
+                    *(asyncio.to_thread(cached_hash, p) for p in missing), return_exceptions=True
+                )
+                digests.update((p, h) for p, h in zip(missing, found) if not isinstance(h, Exception))
+            await asyncio.to_thread(record_hashes, list(digests.values()))
+            if unique_ids:
+                await asyncio.to_thread(record_unique_ids, [unique_ids[p] for p in posted if p in unique_ids])
+        except Exception as record_e:
+            log.error(f"Tweet posted but could not record it as posted: {record_e}")
+            recorded = False
+
+        if context:
+            text = f"✅ Twitter post successful!\nCaption: {caption[:100]}"
+            if left_out:
+                text += "\n⚠️ Not posted (upload failed or over the 4-media limit):\n" + "\n".join(left_out)
+            if not recorded:
+                text += "\n⚠️ Could not record these files as posted; a repost won't be flagged as a duplicate."
+            try:
+                await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=text)
+            except Exception as notify_e:
+                log.warning(f"Could not send success DM: {notify_e}")
 
-async def process_and_post_media(file_paths: list, caption: str, context: ContextTypes.DEFAULT_TYPE):
+async def process_and_post_media(file_paths: list, caption: str, context: ContextTypes.DEFAULT_TYPE,
+                                 unique_ids: Optional[Dict[str, str]] = None,
+                                 hashes: Optional[Dict[str, str]] = None):
+    if await _requeue_if_rate_limited(file_paths, caption, unique_ids, hashes):
+        return
     if not file_paths:
         try:
-            client.create_tweet(text=caption)
+            await _create_tweet(text=caption)
             await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=f"✅ Twitter post successful!\nCaption: {caption[:100]}")
         except Exception as e:
             log.error(f"Failed posting tweet: {e}")
         return
 
-    hashes = [hash_file(p) for p in file_paths]
-    existing_text = HASH_TRACK_FILE.read_text(encoding="utf-8") if HASH_TRACK_FILE.exists() else ""
-    is_dup = any(h in existing_text for h in hashes)
+    # the same Telegram file posted before is a duplicate without reading it from disk
+    unique_ids = unique_ids or {}
+    hashes = dict(hashes or {})
+    is_dup = any(unique_ids.get(p) in posted_unique_ids for p in file_paths)
+    if not is_dup:
+        # digests taken at download time are reused; only hash what is missing,
+        # off the event loop (hashlib releases the GIL so files hash in parallel)
+        missing = [p for p in file_paths if p not in hashes]
+        if missing:
+            digests = await asyncio.gather(*(asyncio.to_thread(cached_hash, p) for p in missing))
+            hashes.update(zip(missing, digests))
+        is_dup = any(is_posted_hash(hashes[p]) for p in file_paths)
 
     if is_dup:
+        dropped = _expire_approvals()
         approval_id = _new_approval_id()
-        pending_approvals[approval_id] = {
+        item = pending_approvals[approval_id] = {
             "media_paths": file_paths,
             "caption": caption,
-            "created_at": int(time.time())
+            "hashes": hashes,
+            "unique_ids": unique_ids,
+            "created_at": _now_ts()
         }
+        evicted = {}
+        if len(pending_approvals) > PENDING_APPROVALS_MAX:
+            oldest, oldest_item = pending_approvals.popitem(last=False)
+            evicted[oldest] = oldest_item
+            log.warning(f"Too many pending approvals; dropped {oldest}")
+        await asyncio.to_thread(db_save_approval, approval_id, item, [*dropped, *evicted])
+        await _notify_dropped_approvals(dropped, context, "expired without a reply")
+        await _notify_dropped_approvals(evicted, context, "too many pending approvals")
         file_list = "\n".join(file_paths[:8]) + (f"\n...(+{len(file_paths)-8} more)" if len(file_paths) > 8 else "")
         await context.bot.send_message(
             chat_id=ADMIN_CHAT_ID,
@@ -372,7 +891,7 @@ async def process_and_post_media(file_paths: list, caption: str, context: Contex
         log.info(f"Duplicate detected, approval {approval_id} requested.")
         return
 
-    await _post_media_now(file_paths, caption, context)
+    await _post_media_now(file_paths, caption, context, hashes=hashes, unique_ids=unique_ids)
 
 # Command handlers for approval
 async def ok_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -393,8 +912,10 @@ async def ok_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     item = pending_approvals.pop(approval_id)
+    await asyncio.to_thread(db_delete_approvals, [approval_id])
     await update.effective_message.reply_text(f"Approval {approval_id} received — posting now.")
-    await _post_media_now(item["media_paths"], item["caption"], context)
+    await _post_media_now(item["media_paths"], item["caption"], context,
+                          hashes=item.get("hashes"), unique_ids=item.get("unique_ids"))
 
 async def ignore_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.id != ADMIN_CHAT_ID:
@@ -414,6 +935,7 @@ async def ignore_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     pending_approvals.pop(approval_id, None)
+    await asyncio.to_thread(db_delete_approvals, [approval_id])
     await update.effective_message.reply_text(f"Ignored pending approval {approval_id}.")
 
 async def list_approvals_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -429,32 +951,94 @@ async def list_approvals_command(update: Update, context: ContextTypes.DEFAULT_T
         lines.append(f"{aid}: {len(item['media_paths'])} files queued at {created} — preview: {item['caption'][:80]}")
     await update.effective_message.reply_text("\n".join(lines))
 
-async def process_queue(context: ContextTypes.DEFAULT_TYPE):
-    items = db_pop_due_items()
-    for item in items:
-        _, media_json, caption, _ = item
-        media_paths = json.loads(media_json)
-        await process_and_post_media(media_paths, caption, context)
+JANITOR_INTERVAL = 600
 
-async def scheduled_poster(context: ContextTypes.DEFAULT_TYPE):
-    await process_queue(context)
+async def pending_janitor(context: ContextTypes.DEFAULT_TYPE):
+    # albums whose debounce task is gone will never finalize
+    for key in [k for k in pending_albums if k not in pending_album_tasks]:
+        log.warning(f"Dropping album {key} that never finalized")
+        _drop_album(key)
+    await _drop_expired_approvals(context)
+
+async def _drop_expired_approvals(context):
+    expired = _expire_approvals()
+    if expired:
+        await asyncio.to_thread(db_delete_approvals, expired)
+        log.info(f"Expired {len(expired)} unanswered approval(s): {', '.join(expired)}")
+        await _notify_dropped_approvals(expired, context, "expired without a reply")
+
+async def process_queue(context: ContextTypes.DEFAULT_TYPE):
+    items = await asyncio.to_thread(db_pop_due_items)
+    for i, (media_paths, caption, _, unique_ids, hashes) in enumerate(items):
+        if _poster_stopping:
+            # popped rows are already out of the table; put the unposted ones back as they were
+            await asyncio.to_thread(db_add_queue_items, items[i:])
+            log.info(f"Shutting down; returned {len(items) - i} due post(s) to the queue.")
+            return
+        try:
+            await process_and_post_media(media_paths, caption, context, unique_ids=unique_ids, hashes=hashes)
+        except Exception:
+            # the rest of the batch is already popped too; one bad post must not take it down
+            log.exception(f"Failed to process queued post {media_paths}")
+
+# The poster sleeps until the earliest scheduled post is due, waking early
+# whenever an insert lands. POSTER_IDLE_TIMEOUT caps every sleep as a safety net.
+POSTER_IDLE_TIMEOUT = 3600
+POSTER_ERROR_DELAY = 5
+_poster_task: Optional[asyncio.Task] = None
+_poster_stopping = False
+
+async def poster_loop(context: ContextTypes.DEFAULT_TYPE):
+    while not _poster_stopping:
+        _queue_changed.clear()
+        try:
+            next_due = await asyncio.to_thread(db_next_due_time)
+            if next_due is not None and next_due <= time.time():
+                await process_queue(context)
+                continue
+        except Exception:
+            log.exception("Scheduled posting failed")
+            await asyncio.sleep(POSTER_ERROR_DELAY)
+            continue
+        delay = POSTER_IDLE_TIMEOUT if next_due is None else min(next_due - time.time(), POSTER_IDLE_TIMEOUT)
+        try:
+            await asyncio.wait_for(_queue_changed.wait(), timeout=max(0.0, delay))
+        except asyncio.TimeoutError:
+            pass
+
+async def start_poster(application):
+    global _poster_task
+    context = CallbackContext(application)
+    # report approvals that expired while the bot was down
+    await _drop_expired_approvals(context)
+    _poster_task = asyncio.create_task(poster_loop(context))
+    log.info("Started scheduled poster")
+
+async def stop_poster(application):
+    # runs as post_stop, while the bot can still send; let the current post finish
+    global _poster_stopping
+    _poster_stopping = True
+    _queue_changed.set()
+    if _poster_task is not None:
+        await _poster_task
+    log.info("Stopped scheduled poster")
 
 # ============= Basic Commands =============
 async def show_queue(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    rows = db_get_next_items(10)
+    rows = await asyncio.to_thread(db_get_next_items, 10)
     if not rows:
         await update.effective_message.reply_text("Queue is empty.")
         return
     msgs = []
     for row in rows:
-        files = json.loads(row[1])
+        files = row[1]
         when = datetime.fromtimestamp(row[3], tz=timezone.utc).strftime("%Y-%m-%d %H:%M UTC")
         preview = (row[2][:50] + "...") if row[2] and len(row[2]) > 50 else row[2]
         msgs.append(f"ID {row[0]}: {files} scheduled {when}\nCaption: {preview}")
     await update.effective_message.reply_text("\n\n".join(msgs))
 
 async def clear_queue(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    db_clear_queue()
+    await asyncio.to_thread(db_clear_queue)
     await update.effective_message.reply_text("Queue cleared.")
 
 async def ping(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -463,7 +1047,23 @@ async def ping(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ============= Main =============
 def main():
     db_init()
-    application = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+    load_posted_hashes()
+    load_pending_approvals()
+    application = (
+        ApplicationBuilder()
+        .token(TELEGRAM_TOKEN)
+        .post_init(start_poster)
+        .post_stop(stop_poster)
+        .build()
+    )
+
+    # Channel media is by far the most frequent update, so check it first;
+    # it never matches commands, so the command handlers are unaffected.
+    # Updates are handled one at a time so single posts are queued in channel order;
+    # album downloads already run as background tasks.
+    application.add_handler(
+        MessageHandler(filters.ALL & ~filters.COMMAND, media_to_queue)
+    )
 
     # If you added handlers earlier in your file, keep them; otherwise add here
     application.add_handler(CommandHandler("queue", show_queue))
@@ -474,18 +1074,10 @@ def main():
     application.add_handler(CommandHandler("ignore", ignore_command))
     application.add_handler(CommandHandler("approvals", list_approvals_command))
 
-    application.add_handler(
-        MessageHandler(filters.ALL & ~filters.COMMAND, media_to_queue)
-    )
-
-    # Start scheduled poster: prefer job_queue, otherwise fallback to asyncio task
     if getattr(application, "job_queue", None) is not None:
-        try:
-            application.job_queue.run_repeating(scheduled_poster, interval=60, first=5)
-            log.info("Started scheduled_poster via application.job_queue")
-        except Exception:
-            log.exception("Failed to start scheduled_poster via job_queue; will use asyncio fallback")
-            application.job_queue = None
+        application.job_queue.run_repeating(pending_janitor, interval=JANITOR_INTERVAL, first=JANITOR_INTERVAL)
+    else:
+        log.warning("No job_queue available; pending albums and approvals won't be swept")
 
     if getattr(application, "_periodic_task", None):
         # `_periodic_task` is set earlier as coroutine function; create the background task via Application's create_task